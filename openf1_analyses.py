@@ -1,11 +1,15 @@
 import openf1_get as g
 import openf1_file_helpers as fh
+import openf1_conditions as cond
+import openf1_location as loc
 import pandas as pd
 
 
-def qualifying_runs(session_key, analysis_depth='shallow'):
+def qualifying_runs(session_key, analysis_depth='shallow', correct_conditions=False, condition_model=None):
     """Produce an analysis of short runs in free practice"""
     round_to = 2
+    gap_column = 'corrected_gap_to_leader' if correct_conditions else 'gap_to_leader'
+    pace_column = 'corrected_lap_duration' if correct_conditions else 'lap_duration'
 
     def get_session_info(session_key_):
         query = ("sessions", {"session_key": session_key_})
@@ -16,6 +20,8 @@ def qualifying_runs(session_key, analysis_depth='shallow'):
     def get_and_sort_laps(session_key_):
         query = ("laps", {'session_key': session_key_})
         df = g.get(query[0], query[1])
+        if correct_conditions:
+            df = correct_for_conditions(df, session_key_)
         df.drop(
             ['meeting_key', 'session_key', 'date_start', 'segments_sector_1', 'segments_sector_2', 'segments_sector_3'],
             axis=1, inplace=True)
@@ -23,6 +29,19 @@ def qualifying_runs(session_key, analysis_depth='shallow'):
 
         return df
 
+    def correct_for_conditions(df_laps_, session_key_):
+        # Without a model, use the one fitted across the season's practice sessions rather than this session alone
+        model = condition_model
+        if model is None:
+            model = cond.season_condition_model(int(get_session_info(session_key_)["year"].iloc[0]))
+
+        # Weather has to be joined while the lap start dates are still there, then only the corrected pace is kept
+        df_weather = cond.get_weather(session_key_)
+        df = cond.correct_laps(df_laps_, df_weather, model)
+        df.drop(cond.WEATHER_COLUMNS + ['session_minutes', 'condition_correction'], axis=1, inplace=True)
+
+        return df
+
     def get_and_sort_stints(session_key_):
         query = ("stints", {'session_key': session_key_})
         df = g.get(query[0], query[1])
@@ -81,26 +100,29 @@ def qualifying_runs(session_key, analysis_depth='shallow'):
             'i1_speed',
             'i2_speed',
             'lap_duration',
+            'corrected_lap_duration',
             'st_speed'
         ]
         float_columns = [column for column in float_columns if column in df.columns]
         for column in float_columns:
             df[column] = pd.to_numeric(df[column], errors="coerce").astype("float64")
 
-        # Give each lap a pace score relative to the stint
-        df['best_lap_in_group'] = df.groupby('driver_number_x')['lap_duration'].transform('min')
+        # Give each lap a pace score relative to the stint, on corrected pace when correcting for conditions
+        df['best_lap_in_group'] = df.groupby('driver_number_x')[pace_column].transform('min')
         df['pct_gap_to_best_lap'] = round(
-            ((df["lap_duration"] / df["best_lap_in_group"]) - 1.0) * 100.0
+            ((df[pace_column] / df["best_lap_in_group"]) - 1.0) * 100.0
             , round_to)
         df.drop('best_lap_in_group', axis=1, inplace=True)
 
-        # Sector pace scores per stint
+        # Sector pace scores per stint, with sectors scaled by the same correction as the lap
         groupby_columns = ['driver_number_x', 'stint_number']
         sector_columns = ['duration_sector_1', 'duration_sector_2', 'duration_sector_3']
-        best_sectors = df.groupby(groupby_columns)[sector_columns].transform('min')
+        pace_ratio = df[pace_column] / df['lap_duration']
+        sectors = df[sector_columns].mul(pace_ratio, axis=0)
+        best_sectors = sectors.groupby([df[column] for column in groupby_columns]).transform('min')
         for sector_column in sector_columns:
             df[f"{sector_column}_pct_gap_to_best"] = round(
-                ((df[sector_column] / best_sectors[sector_column]) - 1.0) * 100.0
+                ((sectors[sector_column] / best_sectors[sector_column]) - 1.0) * 100.0
                 , round_to)
         sector_gap_columns = [f"{sector_column}_pct_gap_to_best" for sector_column in sector_columns]
         df['fast_sectors'] = (df[sector_gap_columns] <= max_sector_gap).sum(axis=1)
@@ -138,6 +160,8 @@ def qualifying_runs(session_key, analysis_depth='shallow'):
             'st_speed',
             'st_speed_delta_to_best'
         ]
+        if correct_conditions:
+            column_order.insert(column_order.index('lap_duration') + 1, 'corrected_lap_duration')
         df = df.loc[:, column_order]
 
         # Filter according to our conditions
@@ -167,6 +191,9 @@ def qualifying_runs(session_key, analysis_depth='shallow'):
 
         # Add comparison statistics
         df['gap_to_leader'] = round(df['lap_duration'] - df['lap_duration'].min(), round_to)
+        if correct_conditions:
+            df['corrected_gap_to_leader'] = round(
+                df['corrected_lap_duration'] - df['corrected_lap_duration'].min(), round_to)
         df['sector_1_gap_to_leader'] = round(df['duration_sector_1'] - df['duration_sector_1'].min(), round_to)
         df['sector_2_gap_to_leader'] = round(df['duration_sector_2'] - df['duration_sector_2'].min(), round_to)
         df['sector_3_gap_to_leader'] = round(df['duration_sector_3'] - df['duration_sector_3'].min(), round_to)
@@ -206,20 +233,23 @@ def qualifying_runs(session_key, analysis_depth='shallow'):
             'st_speed',
             'st_delta_to_leader'
         ]
+        if correct_conditions:
+            index = column_order.index('gap_to_leader') + 1
+            column_order[index:index] = ['corrected_lap_duration', 'corrected_gap_to_leader']
         df = df.loc[:, column_order]
 
         # Reorder rows for readability
-        row_order = df.groupby('driver_number')['gap_to_leader'].min().sort_values().index
+        row_order = df.groupby('driver_number')[gap_column].min().sort_values().index
         df['driver_number'] = pd.Categorical(df['driver_number'], categories=row_order, ordered=True)
-        df = df.sort_values(["driver_number", "gap_to_leader"], ascending=[True, True])
+        df = df.sort_values(["driver_number", gap_column], ascending=[True, True])
 
         return df
 
     def simplify_analysis(df):
         best = (
-            df.dropna(subset=["gap_to_leader"])
-            .loc[df.groupby("driver_number")["gap_to_leader"].idxmin()]
-            .sort_values(["gap_to_leader", "driver_number"])
+            df.dropna(subset=[gap_column])
+            .loc[df.groupby("driver_number")[gap_column].idxmin()]
+            .sort_values([gap_column, "driver_number"])
             .reset_index(drop=True)
         )
 
@@ -236,6 +266,9 @@ def qualifying_runs(session_key, analysis_depth='shallow'):
         else:
             filename = f"{session_year}-{session_location}-{session_name}-Deep_QRA"
 
+        if correct_conditions:
+            filename += "-Corrected"
+
         return filename
 
     df_laps = get_and_sort_laps(session_key)
@@ -253,12 +286,14 @@ def qualifying_runs(session_key, analysis_depth='shallow'):
     return df_qra
 
 
-def long_runs(session_key):
+def long_runs(session_key, correct_conditions=False, condition_model=None):
     """Produce an analysis of long runs in free practice"""
 
     def get_and_sort_laps(session_key_):
         query = ("laps", {'session_key': session_key_})
         df = g.get(query[0], query[1])
+        if correct_conditions:
+            df = correct_for_conditions(df, session_key_)
         df.drop(
             ['meeting_key', 'session_key', 'date_start', 'segments_sector_1', 'segments_sector_2', 'segments_sector_3'],
             axis=1, inplace=True)
@@ -266,6 +301,19 @@ def long_runs(session_key):
 
         return df
 
+    def correct_for_conditions(df_laps_, session_key_):
+        # Without a model, use the one fitted across the season's practice sessions rather than this session alone
+        model = condition_model
+        if model is None:
+            model = cond.season_condition_model(int(get_session_info(session_key_)["year"].iloc[0]))
+
+        # Weather has to be joined while the lap start dates are still there, then only the corrected pace is kept
+        df_weather = cond.get_weather(session_key_)
+        df = cond.correct_laps(df_laps_, df_weather, model)
+        df.drop(cond.WEATHER_COLUMNS + ['session_minutes', 'condition_correction'], axis=1, inplace=True)
+
+        return df
+
     def get_and_sort_stints(session_key_):
         query = ("stints", {'session_key': session_key_})
         df = g.get(query[0], query[1])
@@ -308,6 +356,8 @@ def long_runs(session_key):
         session_location = df_session["location"].iloc[0]
         session_name = df_session["session_name"].iloc[0]
         filename = f"{session_year}-{session_location}-{session_name}-LRA"
+        if correct_conditions:
+            filename += "-Corrected"
 
         return filename
 
@@ -318,6 +368,44 @@ def long_runs(session_key):
     fh.save_analysis(df_ls, 'long runs', get_filename(session_key))
 
 
+def corner_speeds(session_key):
+    """Produce an analysis of minimum and exit speeds through every corner, for every driver and lap"""
+
+    def get_session_info(session_key_):
+        query = ("sessions", {"session_key": session_key_})
+        df = g.get(query[0], query[1])
+
+        return df
+
+    def get_filename(df_session_):
+        session_year = df_session_["year"].iloc[0]
+        session_location = df_session_["location"].iloc[0]
+        session_name = df_session_["session_name"].iloc[0]
+        filename = f"{session_year}-{session_location}-{session_name}-Corners"
+
+        return filename
+
+    def get_track_samples(session_key_, index_):
+        df_laps = loc.get_laps(session_key_)
+        df = loc.get_lap_samples(session_key_, df_laps)
+        df = loc.project_to_track(df, index_)
+
+        return df
+
+    df_session = get_session_info(session_key)
+    circuit_key = int(df_session["circuit_key"].iloc[0])
+
+    # The reference path is only built from this session if the circuit hasn't been cached before
+    index = loc.get_circuit_index(circuit_key, session_key)
+    df_corners = loc.detect_corners(index)
+    df_samples = get_track_samples(session_key, index)
+    df_corner_speeds = loc.corner_speeds(df_samples, df_corners, index)
+
+    df_corner_speeds.insert(0, 'session_key', session_key)
+    fh.save_analysis(df_corner_speeds, 'corner speeds', get_filename(df_session))
+    return df_corner_speeds
+
+
 def teammate_comparison():
     """Produce an analysis of the comparison between teammates in a season"""
     SEASON_2025 = {'2025-02-25', '2025-12-10'}
@@ -0,0 +1,153 @@
+"""Command line entry point for the common analyses
+
+Heavy modules (pandas, requests and everything built on them) are only imported inside the commands that need
+them, so cheap commands like `cache stats` return without loading them.
+
+    python openf1_cli.py qra 9898 --deep
+    python openf1_cli.py long-runs 9898 --correct-conditions
+    python openf1_cli.py backfill 2025 --session-type Practice
+    python openf1_cli.py cache stats
+    python openf1_cli.py cache list
+    python openf1_cli.py cache clear --before 2025-03-01
+    python openf1_cli.py live --interval 60
+"""
+import argparse
+import datetime
+import sys
+import time
+
+import openf1_file_helpers as fh
+
+BACKFILL_ENDPOINTS = ["laps", "stints", "drivers", "weather"]
+
+
+def qra(args):
+    import openf1_analyses as analyses
+
+    analysis_depth = 'deep' if args.deep else 'shallow'
+    df = analyses.qualifying_runs(args.session_key, analysis_depth, correct_conditions=args.correct_conditions)
+    print(df.to_string(index=False))
+
+
+def long_runs(args):
+    import openf1_analyses as analyses
+
+    analyses.long_runs(args.session_key, correct_conditions=args.correct_conditions)
+
+
+def backfill(args):
+    import openf1_get as g
+    import pandas as pd
+
+    # The season's schedule is always fetched fresh, and cached whole so get() can serve the same query later
+    query = ("sessions", {"year": args.year})
+    df_sessions = g.get(query[0], query[1], use_cache=False)
+    fh.cache_response(df_sessions, "sessions", f"year={args.year}")
+
+    # Only finished sessions are cached, since get() serves cached files instead of the API from then on
+    if args.session_type is not None:
+        df_sessions = df_sessions[df_sessions['session_type'] == args.session_type]
+    date_end = pd.to_datetime(df_sessions['date_end'], utc=True, format="ISO8601")
+    df_sessions = df_sessions[date_end < datetime.datetime.now(datetime.timezone.utc)]
+
+    for session_key in df_sessions['session_key'].unique():
+        # The analyses look each session up on its own, so cache its row of the schedule under that query too
+        filename = f"session_key={session_key}"
+        if args.force or fh.cached_response_path("sessions", filename) is None:
+            fh.cache_response(df_sessions[df_sessions['session_key'] == session_key], "sessions", filename)
+
+        for endpoint in args.endpoints:
+            filename = f"session_key={session_key}"
+            if not args.force and fh.cached_response_path(endpoint, filename) is not None:
+                continue
+            df = g.get(endpoint, {"session_key": session_key}, use_cache=False)
+            fh.cache_response(df, endpoint, filename)
+
+
+def cache_stats(args):
+    stats = fh.cache_stats()
+    for endpoint, endpoint_stats in sorted(stats.items()):
+        print(f"{endpoint}\t{endpoint_stats['files']} files\t{endpoint_stats['bytes'] / 1e6:.1f} MB")
+
+    total_files = sum(endpoint_stats['files'] for endpoint_stats in stats.values())
+    total_bytes = sum(endpoint_stats['bytes'] for endpoint_stats in stats.values())
+    print(f"total\t{total_files} files\t{total_bytes / 1e6:.1f} MB")
+
+
+def cache_list(args):
+    sessions = fh.list_cached_sessions()
+    for session_key in sorted(sessions, key=lambda key: int(key) if key.isdigit() else -1):
+        print(f"{session_key}\t{','.join(sorted(sessions[session_key]))}")
+
+
+def cache_clear(args):
+    before = datetime.datetime.now() if args.before is None else datetime.datetime.strptime(args.before, "%Y-%m-%d")
+    removed = fh.clear_cache(before, args.endpoint)
+    print(f"Removed {removed} cached files")
+
+
+def live(args):
+    import openf1_analyses as analyses
+
+    analysis_depth = 'deep' if args.deep else 'shallow'
+    try:
+        while True:
+            # One failed poll (API error, no laps yet, ...) shouldn't stop the loop
+            try:
+                df = analyses.qualifying_runs('latest', analysis_depth)
+                print(df.to_string(index=False))
+            except Exception as e:
+                print(f"live: Analysis failed, retrying in {args.interval} seconds: {e}", file=sys.stderr)
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="openf1", description="Run Open F1 analyses and manage the local cache")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_qra = subparsers.add_parser("qra", help="Qualifying run analysis of a practice session")
+    parser_qra.add_argument("session_key")
+    parser_qra.add_argument("--deep", action="store_true", help="Keep every qualifying run, not just the best")
+    parser_qra.add_argument("--correct-conditions", action="store_true", help="Add weather and track evolution corrected pace")
+    parser_qra.set_defaults(func=qra)
+
+    parser_long_runs = subparsers.add_parser("long-runs", help="Long run analysis of a practice session")
+    parser_long_runs.add_argument("session_key")
+    parser_long_runs.add_argument("--correct-conditions", action="store_true", help="Add weather and track evolution corrected pace")
+    parser_long_runs.set_defaults(func=long_runs)
+
+    parser_backfill = subparsers.add_parser("backfill", help="Fetch and cache session data for a whole season")
+    parser_backfill.add_argument("year", type=int)
+    parser_backfill.add_argument("--session-type", help="Only backfill one type of session (Practice, Qualifying, Race, ...)")
+    parser_backfill.add_argument("--endpoints", nargs="+", default=BACKFILL_ENDPOINTS)
+    parser_backfill.add_argument("--force", action="store_true", help="Fetch sessions that are already cached again")
+    parser_backfill.set_defaults(func=backfill)
+
+    parser_cache = subparsers.add_parser("cache", help="Inspect or clear the local cache")
+    cache_subparsers = parser_cache.add_subparsers(dest="cache_command", required=True)
+    cache_subparsers.add_parser("stats", help="Files and size cached per endpoint").set_defaults(func=cache_stats)
+    cache_subparsers.add_parser("list", help="Sessions with cached data").set_defaults(func=cache_list)
+    parser_cache_clear = cache_subparsers.add_parser("clear", help="Remove cached files")
+    parser_cache_clear.add_argument("--before", help="Only remove files cached before this date (YYYY-MM-DD)")
+    parser_cache_clear.add_argument("--endpoint", help="Only remove files cached for this endpoint (needed to clear circuits)")
+    parser_cache_clear.set_defaults(func=cache_clear)
+
+    parser_live = subparsers.add_parser("live", help="Repeat the qualifying run analysis on the latest session")
+    parser_live.add_argument("--interval", type=int, default=60, help="Seconds between analyses")
+    parser_live.add_argument("--deep", action="store_true", help="Keep every qualifying run, not just the best")
+    parser_live.set_defaults(func=live)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
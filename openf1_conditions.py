@@ -0,0 +1,256 @@
+import openf1_get as g
+import openf1_file_helpers as fh
+import datetime
+import numpy as np
+import pandas as pd
+
+CONDITION_FEATURES = [  # In order of priority: a feature collinear with an earlier one is dropped from the fit.
+    "session_minutes",  # Minutes since the first lap of the session, used as a proxy for track evolution.
+    "track_temperature",  # Track temperature (°C) at the time the lap started.
+    "air_temperature",  # Air temperature (°C) at the time the lap started.
+    "rainfall"  # Whether there was rainfall when the lap started.
+]
+WEATHER_COLUMNS = ["air_temperature", "track_temperature", "rainfall", "wind_speed", "wind_direction"]
+MAX_WEATHER_GAP = pd.Timedelta(minutes=5)
+MAX_FIT_LAP_GAP = 2  # 2%, the same push lap threshold as the QRA, relative to the best lap of the stint
+MAX_FEATURE_CORRELATION = 0.9  # Features more correlated than this with one already in the model are dropped
+
+
+def get_weather(session_keys):
+    """Fetch the weather for one or more sessions as a single dataframe"""
+    if not isinstance(session_keys, (list, tuple, set, pd.Series, np.ndarray)):
+        session_keys = [session_keys]
+
+    frames = []
+    for session_key in session_keys:
+        query = ("weather", {"session_key": session_key})
+        frames.append(g.get(query[0], query[1]))
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def get_laps(session_keys):
+    """Fetch the laps for one or more sessions as a single dataframe"""
+    if not isinstance(session_keys, (list, tuple, set, pd.Series, np.ndarray)):
+        session_keys = [session_keys]
+
+    frames = []
+    for session_key in session_keys:
+        query = ("laps", {"session_key": session_key})
+        frames.append(g.get(query[0], query[1]))
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def get_stints(session_keys):
+    """Fetch the stints for one or more sessions as a single dataframe"""
+    if not isinstance(session_keys, (list, tuple, set, pd.Series, np.ndarray)):
+        session_keys = [session_keys]
+
+    frames = []
+    for session_key in session_keys:
+        query = ("stints", {"session_key": session_key})
+        frames.append(g.get(query[0], query[1]))
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def join_laps_and_stints(df_laps, df_stints):
+    """As-of join every lap to the stint it was driven in, across any number of sessions"""
+    df_stints = df_stints.loc[:, ["session_key", "driver_number", "stint_number", "lap_start", "lap_end"]]
+    df_stints = df_stints.dropna(subset=["lap_start"]).astype({"lap_start": "int64"}).sort_values("lap_start")
+    df_laps = df_laps.dropna(subset=["lap_number"]).astype({"lap_number": "int64"}).sort_values("lap_number")
+
+    df = pd.merge_asof(
+        df_laps, df_stints,
+        left_on="lap_number", right_on="lap_start", by=["session_key", "driver_number"],
+        direction="backward"
+    )
+
+    # Laps after the end of the last stint they could belong to have no stint
+    df.loc[df["lap_number"] > df["lap_end"], "stint_number"] = np.nan
+    df = df.drop(columns=["lap_start", "lap_end"])
+    df.sort_values(by=["session_key", "driver_number", "lap_number"], inplace=True)
+    df.reset_index(drop=True, inplace=True)
+
+    return df
+
+
+def join_laps_and_weather(df_laps, df_weather):
+    """As-of join every lap to the latest weather reading at the start of the lap, across any number of sessions"""
+    df_laps = df_laps.copy()
+    df_weather = df_weather.loc[:, ["session_key", "date"] + WEATHER_COLUMNS].copy()
+
+    # Timestamps come back as ISO 8601 strings, and merge_asof needs real datetimes sorted on the join key
+    df_laps["_date"] = pd.to_datetime(df_laps["date_start"], utc=True, format="ISO8601")
+    df_weather["_date"] = pd.to_datetime(df_weather["date"], utc=True, format="ISO8601")
+    df_weather.drop("date", axis=1, inplace=True)
+    for column in WEATHER_COLUMNS:
+        df_weather[column] = pd.to_numeric(df_weather[column], errors="coerce").astype("float64")
+
+    # Laps without a start date can't be placed in time, so they are joined separately and get no weather
+    has_date = df_laps["_date"].notna()
+    df_dated = df_laps[has_date].sort_values("_date", kind="stable")
+    df_weather = df_weather.dropna(subset=["_date"]).sort_values("_date", kind="stable")
+
+    df = pd.merge_asof(
+        df_dated, df_weather,
+        on="_date", by="session_key",
+        direction="backward", tolerance=MAX_WEATHER_GAP
+    )
+
+    # Laps that started before the first weather reading of the session fall back to the nearest reading
+    missing = df["track_temperature"].isna()
+    if missing.any():
+        df_nearest = pd.merge_asof(
+            df.loc[missing, df_dated.columns], df_weather,
+            on="_date", by="session_key",
+            direction="nearest", tolerance=MAX_WEATHER_GAP
+        )
+        df.loc[missing, WEATHER_COLUMNS] = df_nearest[WEATHER_COLUMNS].to_numpy()
+
+    # Track evolution is measured from the first lap of each session
+    session_start = df.groupby("session_key")["_date"].transform("min")
+    df["session_minutes"] = (df["_date"] - session_start).dt.total_seconds() / 60.0
+
+    df = pd.concat([df, df_laps[~has_date]], ignore_index=True)
+    df = df.drop(columns=["_date"])
+    df.sort_values(by=["session_key", "driver_number", "lap_number"], inplace=True)
+    df.reset_index(drop=True, inplace=True)
+
+    return df
+
+
+def fit_condition_model(df_conditions):
+    """Fit a track evolution and temperature model to laps that have been joined to the weather and their stints
+
+    Lap times are compared within each stint of a driver's session (a fixed effect per session, driver and stint),
+    so the coefficients describe how much faster or slower the same driver goes on the same run as conditions
+    change. Comparing across stints would mostly measure the run plan instead, i.e. heavy fuel long runs against
+    low fuel qualifying simulations later or earlier in the session.
+    """
+    group_columns = ["session_key", "driver_number", "stint_number"]
+    df = df_conditions.loc[:, group_columns + ["lap_duration", "is_pit_out_lap"] + CONDITION_FEATURES].copy()
+    df["lap_duration"] = pd.to_numeric(df["lap_duration"], errors="coerce").astype("float64")
+
+    # Only fit on push laps: no out laps, no missing data and nothing outside MAX_FIT_LAP_GAP of the stint's best
+    df = df[df["is_pit_out_lap"] != True]
+    df = df.dropna(subset=["lap_duration", "stint_number"] + CONDITION_FEATURES)
+    best_lap = df.groupby(group_columns)["lap_duration"].transform("min")
+    df = df[((df["lap_duration"] / best_lap) - 1.0) * 100.0 <= MAX_FIT_LAP_GAP]
+
+    if df.empty:
+        raise Exception("Error fitting condition model: Not enough lap and weather data")
+
+    # Demean within each stint so only the change in conditions explains the change in lap time
+    columns = ["lap_duration"] + CONDITION_FEATURES
+    demeaned = df[columns] - df.groupby(group_columns)[columns].transform("mean")
+
+    # Drop features that never change within a session (e.g. no rain all season), and features that move together
+    # with one already kept (e.g. air and track temperature), since their coefficients can't be told apart
+    correlation = demeaned[CONDITION_FEATURES].corr().abs()
+    features = []
+    for feature in CONDITION_FEATURES:
+        if not demeaned[feature].std() > 0:
+            continue
+        collinear = [kept for kept in features if correlation.loc[feature, kept] > MAX_FEATURE_CORRELATION]
+        if collinear:
+            print(f"fit_condition_model(): Dropping {feature}, it is collinear with {', '.join(collinear)}")
+            continue
+        features.append(feature)
+    if not features:
+        raise Exception("Error fitting condition model: No condition changes within sessions to fit")
+
+    coefficients, _, _, _ = np.linalg.lstsq(
+        demeaned[features].to_numpy(dtype="float64"),
+        demeaned["lap_duration"].to_numpy(dtype="float64"),
+        rcond=None
+    )
+
+    residuals = demeaned["lap_duration"].to_numpy() - demeaned[features].to_numpy() @ coefficients
+    model = {
+        "coefficients": dict(zip(features, coefficients.tolist())),
+        "residual_std": float(np.std(residuals)),
+        "n_laps": int(len(df))
+    }
+
+    return model
+
+
+def apply_condition_model(df_conditions, model):
+    """Add corrected pace columns, normalising every lap to the average conditions of its session"""
+    df = df_conditions.copy()
+    coefficients = model["coefficients"]
+    features = list(coefficients.keys())
+
+    # The correction is relative to the mean conditions of each session, so laps in the same session become comparable
+    session_means = df.groupby("session_key")[features].transform("mean")
+    deltas = (df[features] - session_means).fillna(0.0)
+    correction = deltas.to_numpy(dtype="float64") @ np.array([coefficients[f] for f in features], dtype="float64")
+
+    df["condition_correction"] = correction
+    df["corrected_lap_duration"] = pd.to_numeric(df["lap_duration"], errors="coerce") - correction
+
+    return df
+
+
+def correct_laps(df_laps, df_weather, model=None, df_stints=None):
+    """Join laps to the weather and apply a condition model, fitting one on these laps and stints if none is given"""
+    df = join_laps_and_weather(df_laps, df_weather)
+    if model is None:
+        if df_stints is None:
+            raise Exception("Error correcting laps: Fitting a condition model needs the stints")
+        model = fit_condition_model(join_laps_and_stints(df, df_stints))
+
+    return apply_condition_model(df, model)
+
+
+def sessions_condition_model(session_keys):
+    """Fit a single condition model across many sessions"""
+    df_laps = get_laps(session_keys)
+    df_weather = get_weather(session_keys)
+    df_stints = get_stints(session_keys)
+    df = join_laps_and_weather(df_laps, df_weather)
+    df = join_laps_and_stints(df, df_stints)
+
+    return fit_condition_model(df)
+
+
+def season_condition_model(year, session_type="Practice"):
+    """Return the condition model fitted on every finished session of a type in a season
+
+    The cache is keyed by the number of finished sessions and the latest of them, so the model is refitted as soon
+    as another session of the season has finished.
+    """
+    # The schedule is always fetched fresh, since a cached copy wouldn't show which sessions have finished since
+    query = ("sessions", {"year": year})
+    df_sessions = g.get(query[0], query[1], use_cache=False)
+    date_end = pd.to_datetime(df_sessions["date_end"], utc=True, format="ISO8601")
+    df_sessions = df_sessions[
+        (df_sessions["session_type"] == session_type) & (date_end < datetime.datetime.now(datetime.timezone.utc))]
+    if df_sessions.empty:
+        raise Exception("Error fitting condition model: No finished sessions in season", year, session_type)
+
+    session_keys = df_sessions["session_key"].unique()
+    filename = f"year={year}-{session_type}-sessions={len(session_keys)}-latest={session_keys.max()}"
+    cached_path = fh.cached_response_path("condition_models", filename)
+    if cached_path is not None:
+        df = pd.read_csv(cached_path)
+        model = {
+            "coefficients": dict(zip(df["feature"], df["coefficient"])),
+            "residual_std": float(df["residual_std"].iloc[0]),
+            "n_laps": int(df["n_laps"].iloc[0])
+        }
+
+        return model
+
+    model = sessions_condition_model(session_keys)
+    df = pd.DataFrame({
+        "feature": list(model["coefficients"].keys()),
+        "coefficient": list(model["coefficients"].values()),
+        "residual_std": model["residual_std"],
+        "n_laps": model["n_laps"]
+    })
+    fh.cache_response(df, "condition_models", filename)
+
+    return model
@@ -1,6 +1,8 @@
 import os
 import datetime
 
+KEEP_ON_CLEAR = ("util", "circuits")  # Never cleared: the last get date and reference paths that are built only once
+
 
 def cache_response(df, endpoint, filename):
     """Save output of a certain response so you can query it locally"""
@@ -15,9 +17,64 @@ def cache_response(df, endpoint, filename):
     df.to_csv(final_file_path, index=False)
 
 
-def clear_cache(date):
-    """Clear cache from before a certain date"""
-    pass
+def cached_response_path(endpoint, filename):
+    """Return the path of a cached response, or None if it hasn't been cached yet"""
+    final_file_path = os.path.join("cache", endpoint, filename) + ".csv"
+    if not os.path.exists(final_file_path):
+        return None
+
+    return final_file_path
+
+
+def clear_cache(date, endpoint=None):
+    """Clear cache from before a certain date, except what's in KEEP_ON_CLEAR unless that endpoint is asked for"""
+    directory = "cache" if endpoint is None else os.path.join("cache", endpoint)
+    cutoff = date.timestamp()
+    removed = 0
+
+    for root, _, filenames in os.walk(directory):
+        if endpoint is None and os.path.relpath(root, "cache").split(os.sep)[0] in KEEP_ON_CLEAR:
+            continue
+        for filename in filenames:
+            filepath = os.path.join(root, filename)
+            if os.path.getmtime(filepath) < cutoff:
+                os.remove(filepath)
+                removed += 1
+
+    return removed
+
+
+def cache_stats():
+    """Return the number of files and bytes cached for each endpoint"""
+    stats = {}
+    if not os.path.exists("cache"):
+        return stats
+
+    for entry in os.scandir("cache"):
+        if not entry.is_dir() or entry.name == "util":
+            continue
+        files = [f for f in os.scandir(entry.path) if f.is_file()]
+        stats[entry.name] = {"files": len(files), "bytes": sum(f.stat().st_size for f in files)}
+
+    return stats
+
+
+def list_cached_sessions():
+    """Return the endpoints cached for each session, from files named like session_key=9898.csv"""
+    sessions = {}
+    if not os.path.exists("cache"):
+        return sessions
+
+    for entry in os.scandir("cache"):
+        if not entry.is_dir():
+            continue
+        for f in os.scandir(entry.path):
+            name, extension = os.path.splitext(f.name)
+            if extension == ".csv" and name.startswith("session_key="):
+                session_key = name[len("session_key="):]
+                sessions.setdefault(session_key, []).append(entry.name)
+
+    return sessions
 
 
 def save_analysis(df, analysis, filename):
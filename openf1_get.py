@@ -305,8 +305,8 @@ def response_to_df(response):
     return df
 
 
-def get(endpoint, params):
-    """Fetch the response from the desired API endpoint"""
+def get(endpoint, params, use_cache=True):
+    """Fetch the response from the desired API endpoint, or from the cache if it has been backfilled"""
     params = dict(sorted(params.items()))
 
     if parse_request(endpoint, params):
@@ -314,13 +314,18 @@ def get(endpoint, params):
         request = requests.Request("GET", endpoint_url, params=params)
         prepared = request.prepare()
         final_url = parse_operators(prepared.url)
+
+        # Cached responses are named after the query string, e.g. session_key=9898. "latest" always changes
+        filename = final_url[len(endpoint_url) + 1:]
+        cached_path = fh.cached_response_path(endpoint, filename)
+        if use_cache and "latest" not in filename and cached_path is not None:
+            return pd.read_csv(cached_path)
+
         spam_check()
         response = requests.get(final_url)
         fh.save_last_get_date()
         if parse_response(response):
-            # filename = final_url[len(endpoint_url) + 1:]
             df = response_to_df(response)
-            # fh.cache_response(df, endpoint, filename)
             return df
 
     raise Exception("Error fetching API response: Something unexpected went wrong.")
@@ -0,0 +1,374 @@
+import openf1_get as g
+import openf1_file_helpers as fh
+import numpy as np
+import pandas as pd
+
+# Location coordinates are in arbitrary units of roughly a decimetre, so all distances here use the same units
+PATH_SPACING = 5  # Distance between points on the resampled reference path.
+MAX_SNAP_DISTANCE = 150  # Samples further than this from the reference path (pit lane, run-offs) get no track distance.
+# Samples are only matched against their own cell and its 8 neighbours, which only contain every path point within
+# MAX_SNAP_DISTANCE of the sample if the cells are at least that big. Keep GRID_CELL_SIZE >= MAX_SNAP_DISTANCE.
+GRID_CELL_SIZE = MAX_SNAP_DISTANCE  # Side of one cell of the spatial index.
+QUERY_CHUNK_SIZE = 20000  # Number of samples projected at once. Memory is this times the widest cell's candidates.
+
+CORNER_WINDOW = 800  # Distance over which the curvature of the path is smoothed, spanning several location samples.
+CORNER_MAX_RADIUS = 4000  # Points where the smoothed radius is tighter than this (about 400 m) are part of a corner.
+CORNER_MIN_HEADING_CHANGE = 20  # Degrees of total heading change for a run of corner points to count as a corner.
+CORNER_EXIT_DISTANCE = 300  # Distance after the end of a corner at which the exit speed is taken.
+MAX_EXIT_SAMPLE_GAP = pd.Timedelta(seconds=1)  # Longest gap between the two samples the exit speed is interpolated from.
+
+CAR_DATA_TOLERANCE = pd.Timedelta(milliseconds=500)
+
+circuit_indexes = {}  # In-memory cache of reference paths and their spatial indexes, by circuit_key
+
+
+def to_datetime(series):
+    return pd.to_datetime(series, utc=True, format="ISO8601")
+
+
+def get_location(session_key, driver_number):
+    """Fetch the location samples of one driver in a session"""
+    query = ("location", {"session_key": session_key, "driver_number": driver_number})
+    df = g.get(query[0], query[1])
+    df["date"] = to_datetime(df["date"])
+
+    return df
+
+
+def get_car_data(session_key, driver_number):
+    """Fetch the car data samples of one driver in a session"""
+    query = ("car_data", {"session_key": session_key, "driver_number": driver_number})
+    df = g.get(query[0], query[1])
+    df["date"] = to_datetime(df["date"])
+
+    return df
+
+
+def get_laps(session_key):
+    """Fetch the laps of a session with the start and end of every lap as datetimes"""
+    query = ("laps", {"session_key": session_key})
+    df = g.get(query[0], query[1])
+    df["lap_duration"] = pd.to_numeric(df["lap_duration"], errors="coerce").astype("float64")
+    df["date_start"] = to_datetime(df["date_start"])
+    df["date_end"] = df["date_start"] + pd.to_timedelta(df["lap_duration"], unit="s")
+
+    return df
+
+
+def build_reference_path(session_key):
+    """Build a reference path for the circuit from the fastest clean lap of a session
+
+    The path is resampled every PATH_SPACING units so that the nearest path point to any sample gives its track
+    distance to within half the spacing.
+    """
+    df_laps = get_laps(session_key)
+    df_laps = df_laps[df_laps["is_pit_out_lap"] != True]
+    df_laps = df_laps.dropna(subset=["date_start", "lap_duration"])
+    if df_laps.empty:
+        raise Exception("Error building reference path: No clean laps in session", session_key)
+    lap = df_laps.loc[df_laps["lap_duration"].idxmin()]
+
+    df = get_location(session_key, lap["driver_number"])
+    df = df[(df["date"] >= lap["date_start"]) & (df["date"] <= lap["date_end"])].sort_values("date")
+    points = df[["x", "y", "z"]].to_numpy(dtype="float64")
+
+    # Drop repeated samples (car stationary or duplicated), since they add no distance
+    steps = np.linalg.norm(np.diff(points[:, :2], axis=0), axis=1)
+    keep = np.concatenate([[True], steps > 0])
+    points = points[keep]
+    if len(points) < 10:
+        raise Exception("Error building reference path: Not enough location samples for lap", session_key)
+
+    # Close the loop so the end of the lap joins up with the start
+    points = np.vstack([points, points[:1]])
+    distance = np.concatenate([[0.0], np.cumsum(np.linalg.norm(np.diff(points[:, :2], axis=0), axis=1))])
+    resampled_distance = np.arange(0.0, distance[-1], PATH_SPACING)
+
+    df_path = pd.DataFrame({
+        "distance": resampled_distance,
+        "x": np.interp(resampled_distance, distance, points[:, 0]),
+        "y": np.interp(resampled_distance, distance, points[:, 1]),
+        "z": np.interp(resampled_distance, distance, points[:, 2])
+    })
+
+    return df_path
+
+
+def build_grid_index(df_path):
+    """Index the reference path on a uniform grid
+
+    Every cell holds the path points in itself and its 8 neighbours, padded into a single matrix, so a batch of
+    samples can look up all of its candidate points with one fancy-indexing operation.
+    """
+    x = df_path["x"].to_numpy(dtype="float64")
+    y = df_path["y"].to_numpy(dtype="float64")
+
+    # Leave a margin of over a cell around the path so neighbour lookups never fall off the grid, even with rounding
+    x_origin = x.min() - 1.5 * GRID_CELL_SIZE
+    y_origin = y.min() - 1.5 * GRID_CELL_SIZE
+    n_x = int((x.max() - x_origin) // GRID_CELL_SIZE) + 2
+    n_y = int((y.max() - y_origin) // GRID_CELL_SIZE) + 2
+    cell_x = ((x - x_origin) // GRID_CELL_SIZE).astype("int64")
+    cell_y = ((y - y_origin) // GRID_CELL_SIZE).astype("int64")
+
+    # Register every path point in its own cell and all 8 neighbouring cells
+    offsets = np.array([(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1)])
+    point_ids = np.tile(np.arange(len(x)), len(offsets))
+    cell_ids = (np.repeat(offsets[:, 0], len(x)) + np.tile(cell_x, len(offsets))) * n_y \
+        + (np.repeat(offsets[:, 1], len(x)) + np.tile(cell_y, len(offsets)))
+
+    # Group by cell and pad into an (n_cells, max_candidates) matrix, with -1 for empty slots
+    order = np.argsort(cell_ids, kind="stable")
+    cell_ids = cell_ids[order]
+    point_ids = point_ids[order]
+    counts = np.bincount(cell_ids, minlength=n_x * n_y)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    slots = np.arange(len(cell_ids)) - starts[cell_ids]
+    candidates = np.full((n_x * n_y, max(counts.max(), 1)), -1, dtype="int64")
+    candidates[cell_ids, slots] = point_ids
+
+    index = {
+        "x_origin": x_origin,
+        "y_origin": y_origin,
+        "n_x": n_x,
+        "n_y": n_y,
+        "candidates": candidates,
+        "path": df_path[["x", "y", "z"]].to_numpy(dtype="float64"),
+        "distance": df_path["distance"].to_numpy(dtype="float64"),
+        # The path is a closed loop, so the last point is one spacing short of the line
+        "lap_length": float(df_path["distance"].iloc[-1]) + PATH_SPACING
+    }
+
+    return index
+
+
+def get_circuit_index(circuit_key, session_key=None):
+    """Return the spatial index for a circuit, building and caching its reference path the first time
+
+    The reference path is kept in memory and on disk, so it is only built from location data once per circuit. A
+    session_key is only needed when the circuit has never been seen before.
+    """
+    if circuit_key in circuit_indexes:
+        return circuit_indexes[circuit_key]
+
+    filename = f"circuit_key={circuit_key}"
+    cached_path = fh.cached_response_path("circuits", filename)
+    if cached_path is not None:
+        df_path = pd.read_csv(cached_path)
+    elif session_key is not None:
+        df_path = build_reference_path(session_key)
+        fh.cache_response(df_path, "circuits", filename)
+    else:
+        raise Exception("Error building circuit index: No cached reference path and no session given", circuit_key)
+
+    circuit_indexes[circuit_key] = build_grid_index(df_path)
+
+    return circuit_indexes[circuit_key]
+
+
+def project_to_track(df_samples, index):
+    """Add the track distance of every location sample, using the grid index of the circuit
+
+    Samples are projected onto the nearest reference path point in 3D, so that crossovers such as Suzuka's
+    bridge are told apart by height. Samples off the reference path get NaN.
+    """
+    df = df_samples.copy()
+    x = df["x"].to_numpy(dtype="float64")
+    y = df["y"].to_numpy(dtype="float64")
+    z = df["z"].to_numpy(dtype="float64")
+    path_x, path_y, path_z = index["path"].T
+    track_distance = np.full(len(df), np.nan)
+    snap_distance = np.full(len(df), np.nan)
+
+    cell_x = np.floor((x - index["x_origin"]) / GRID_CELL_SIZE)
+    cell_y = np.floor((y - index["y_origin"]) / GRID_CELL_SIZE)
+    on_grid = (cell_x >= 0) & (cell_x < index["n_x"]) & (cell_y >= 0) & (cell_y < index["n_y"])
+    on_grid &= ~(np.isnan(x) | np.isnan(y) | np.isnan(z))
+    rows = np.flatnonzero(on_grid)
+    cell_ids = (cell_x[rows] * index["n_y"] + cell_y[rows]).astype("int64")
+
+    for start in range(0, len(rows), QUERY_CHUNK_SIZE):
+        chunk_rows = rows[start:start + QUERY_CHUNK_SIZE]
+        candidates = index["candidates"][cell_ids[start:start + QUERY_CHUNK_SIZE]]
+        valid = candidates >= 0
+        safe_candidates = np.where(valid, candidates, 0)
+
+        # Add up one axis at a time, so only a couple of (chunk, candidates) arrays are alive at once
+        squared = np.square(path_x[safe_candidates] - x[chunk_rows, None])
+        squared += np.square(path_y[safe_candidates] - y[chunk_rows, None])
+        squared += np.square(path_z[safe_candidates] - z[chunk_rows, None])
+        squared[~valid] = np.inf
+        best = squared.argmin(axis=1)
+        best_squared = squared[np.arange(len(best)), best]
+
+        matched = best_squared <= MAX_SNAP_DISTANCE ** 2
+        track_distance[chunk_rows[matched]] = index["distance"][candidates[np.arange(len(best)), best][matched]]
+        snap_distance[chunk_rows] = np.where(np.isfinite(best_squared), np.sqrt(best_squared), np.nan)
+
+    df["track_distance"] = track_distance
+    df["snap_distance"] = snap_distance
+
+    return df
+
+
+def detect_corners(index):
+    """Find the corners of a circuit from the curvature of its reference path
+
+    A point is part of a corner if its curvature, smoothed over CORNER_WINDOW, is tighter than CORNER_MAX_RADIUS.
+    Runs of corner points turning the same way become one corner if they turn by at least CORNER_MIN_HEADING_CHANGE
+    in total, so chicanes are split into their left and right parts and fast sweepers are still found.
+    """
+    distance = index["distance"]
+    lap_length = index["lap_length"]
+
+    # Heading change between consecutive points, wrapped to [-pi, pi] and smoothed over a window that wraps around the lap
+    path = index["path"]
+    steps = np.diff(np.vstack([path, path[:1]])[:, :2], axis=0)
+    heading = np.arctan2(steps[:, 1], steps[:, 0])
+    heading_change = (np.diff(np.concatenate([heading, heading[:1]])) + np.pi) % (2 * np.pi) - np.pi
+    half_window = max(int(CORNER_WINDOW / PATH_SPACING) // 2, 1)
+    padded = np.concatenate([heading_change[-half_window:], heading_change, heading_change[:half_window]])
+    curvature = np.convolve(padded, np.ones(2 * half_window + 1), mode="valid") / ((2 * half_window + 1) * PATH_SPACING)
+
+    direction = np.where(np.abs(curvature) >= 1.0 / CORNER_MAX_RADIUS, np.sign(curvature), 0).astype("int64")
+    if not (direction == 0).any():
+        raise Exception("Error detecting corners: The whole reference path is one corner")
+
+    # Start the runs from a straight, so a corner that crosses the start/finish line stays in one piece
+    shift = int(np.flatnonzero(direction == 0)[0])
+    order = np.roll(np.arange(len(direction)), -shift)
+    rolled = direction[order]
+
+    run_starts = np.flatnonzero(np.concatenate([[True], rolled[1:] != rolled[:-1]]))
+    run_ends = np.concatenate([run_starts[1:], [len(rolled)]]) - 1
+    corners = []
+    for run_start, run_end in zip(run_starts, run_ends):
+        if rolled[run_start] == 0:
+            continue
+        points = order[run_start:run_end + 1]
+        total_heading_change = float(np.degrees(np.abs(heading_change[points].sum())))
+        if total_heading_change < CORNER_MIN_HEADING_CHANGE:
+            continue
+        apex = points[np.abs(curvature[points]).argmax()]
+        corners.append({
+            "distance_start": distance[points[0]],
+            "distance_apex": distance[apex],
+            "distance_end": distance[points[-1]],
+            "direction": "left" if rolled[run_start] > 0 else "right",
+            "heading_change": round(total_heading_change, 1)
+        })
+
+    df = pd.DataFrame(corners, columns=[
+        "distance_start", "distance_apex", "distance_end", "direction", "heading_change"])
+
+    # Number the corners from the start/finish line, so turn 1 is the first corner after the line
+    df["_order"] = df["distance_start"] + np.where(df["distance_start"] > df["distance_end"], -lap_length, 0)
+    df = df.sort_values("_order").drop(columns=["_order"]).reset_index(drop=True)
+    df.insert(0, "corner_number", np.arange(1, len(df) + 1))
+
+    return df
+
+
+def get_lap_samples(session_key, df_laps):
+    """Fetch location and car data for every driver, joined together and to the lap they belong to"""
+    df_laps = df_laps.loc[:, ["driver_number", "lap_number", "date_start", "date_end"]]
+    df_laps = df_laps.dropna(subset=["date_start"]).sort_values("date_start")
+
+    frames = []
+    for driver_number in df_laps["driver_number"].unique():
+        df_location = get_location(session_key, driver_number).sort_values("date")
+        df_car = get_car_data(session_key, driver_number).loc[:, ["date", "speed"]].sort_values("date")
+        df = pd.merge_asof(
+            df_location, df_car,
+            on="date", direction="nearest", tolerance=CAR_DATA_TOLERANCE
+        )
+        df = pd.merge_asof(
+            df, df_laps[df_laps["driver_number"] == driver_number].drop("driver_number", axis=1),
+            left_on="date", right_on="date_start", direction="backward"
+        )
+        frames.append(df)
+
+    df = pd.concat(frames, ignore_index=True)
+
+    # Samples after the end of a lap with a known duration are in the garage or on an in lap
+    in_lap = df["date_end"].isna() | (df["date"] <= df["date_end"])
+    df = df[in_lap & df["lap_number"].notna()]
+    df = df.drop(["date_start", "date_end"], axis=1)
+    df["speed"] = pd.to_numeric(df["speed"], errors="coerce").astype("float64")
+
+    return df
+
+
+def corner_speeds(df_samples, df_corners, index):
+    """Produce per-corner minimum and exit speeds for every driver and lap
+
+    Track distance is measured from the middle of the longest straight instead of the start/finish line, so no
+    corner or exit zone crosses zero. Each sample is then placed in a corner or its exit zone with a single
+    searchsorted over the corner boundaries.
+    """
+    lap_length = index["lap_length"]
+    df = df_samples.dropna(subset=["track_distance", "speed"])
+    if df_corners.empty:
+        raise Exception("Error producing corner speeds: No corners detected")
+
+    # The longest gap from the end of one corner to the start of the next is the longest straight
+    df_corners = df_corners.sort_values("distance_start").reset_index(drop=True)
+    ends = df_corners["distance_end"].to_numpy()
+    gaps = (np.roll(df_corners["distance_start"].to_numpy(), -1) - ends) % lap_length
+    longest = gaps.argmax()
+    offset = (ends[longest] + gaps[longest] / 2.0) % lap_length
+
+    starts = ((df_corners["distance_start"].to_numpy() - offset) % lap_length)
+    ends = ((df_corners["distance_end"].to_numpy() - offset) % lap_length)
+    order = np.argsort(starts)
+    starts = starts[order]
+    ends = ends[order]
+    corner_numbers = df_corners["corner_number"].to_numpy()[order]
+    starts_before_offset = (df_corners["distance_start"].to_numpy() < offset)[order]
+    exit_limits = np.minimum(ends + CORNER_EXIT_DISTANCE, np.append(starts[1:], lap_length))
+
+    track_distance = df["track_distance"].to_numpy()
+    shifted_distance = (track_distance - offset) % lap_length
+    corner = np.searchsorted(starts, shifted_distance, side="right") - 1
+    has_corner = corner >= 0
+    corner_end = np.where(has_corner, ends[np.clip(corner, 0, None)], -np.inf)
+    exit_limit = np.where(has_corner, exit_limits[np.clip(corner, 0, None)], -np.inf)
+    in_corner = has_corner & (shifted_distance <= corner_end)
+    before_exit = has_corner & (shifted_distance <= exit_limit)
+
+    # Samples past the line but before the offset carry the next lap_number, so they are grouped with the lap before.
+    # A corner is then reported on the lap it starts in, which is the next lap if it starts between the line and offset
+    corner = np.clip(corner, 0, None)
+    lap_number = df["lap_number"].to_numpy() - (track_distance < offset) + starts_before_offset[corner]
+    df = df.assign(corner_number=corner_numbers[corner], lap_number=lap_number, _shifted=shifted_distance,
+                   _exit_limit=exit_limit, _before_exit=before_exit)
+    group_columns = ["driver_number", "lap_number", "corner_number"]
+
+    df_in_corner = df[in_corner]
+    minimum = df_in_corner.loc[df_in_corner.groupby(group_columns)["speed"].idxmin()]
+    minimum = minimum.loc[:, group_columns + ["speed", "track_distance"]].rename(
+        columns={"speed": "min_speed", "track_distance": "min_speed_distance"})
+
+    # The exit speed is interpolated at the exit point, between the last sample before it and the one after it.
+    # The detected end of a corner is smoothed into the corner, so the first sample past it can still be mid-corner
+    df = df.sort_values(["driver_number", "date"])
+    following = df.groupby("driver_number")[["_shifted", "speed", "date"]].shift(-1)
+    following_distance = following["_shifted"].to_numpy()
+    following_distance = np.where(following_distance < df["_shifted"] - lap_length / 2,
+                                  following_distance + lap_length, following_distance)
+    brackets_exit = df["_before_exit"] & (following_distance > df["_exit_limit"]) \
+        & ((following["date"] - df["date"]) <= MAX_EXIT_SAMPLE_GAP)
+    fraction = (df["_exit_limit"] - df["_shifted"]) / (following_distance - df["_shifted"])
+    df["exit_speed"] = df["speed"] + (following["speed"] - df["speed"]) * fraction
+    exit_speed = df[brackets_exit].groupby(group_columns, as_index=False)["exit_speed"].first()
+
+    df = minimum.merge(exit_speed, on=group_columns, how="left")
+    df = df[df["lap_number"] >= 1]  # Corners started before the first lap (e.g. on the grid) have no lap
+    df = df.merge(df_corners.loc[:, ["corner_number", "direction"]], on="corner_number", how="left")
+    df["lap_number"] = df["lap_number"].astype("int64")
+    df = df.loc[:, ["driver_number", "lap_number", "corner_number", "direction", "min_speed", "min_speed_distance",
+                    "exit_speed"]]
+    df.sort_values(by=["driver_number", "lap_number", "corner_number"], inplace=True)
+    df.reset_index(drop=True, inplace=True)
+
+    return df